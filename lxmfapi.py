@@ -1,25 +1,61 @@
-import os, time
-from fastapi import FastAPI, HTTPException, WebSocket
-import RNS
-from LXMF import LXMRouter, LXMessage
-from queue import Queue
+import os, time, signal
+import orjson
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from queue import Full
 from types import SimpleNamespace
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from dataclasses import dataclass
+from typing import Any, Callable
+from collections import deque, OrderedDict
 import threading
 import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Loaded lazily by LXMFAPI.__init__
+RNS = LXMRouter = LXMessage = None
+
+HEARTBEAT_INTERVAL = 25
+# RNS.Reticulum.TRUNCATED_HASHLENGTH // 4, spelled out so RNS loads lazily
+_EXPECTED_HEX_LEN = 32
 
 class MessageRequest(BaseModel):
-    destination: str
+    destination: str = Field(pattern=f'^[0-9a-fA-F]{{{_EXPECTED_HEX_LEN}}}$')
     message: str
     title: str = "Reply"
 
+@dataclass(slots=True)
+class InboundMessage:
+    lxmf: Any
+    reply: Callable
+    sender: str
+    content: str
+    hash: str
+
 class LXMFAPI:
-    delivery_callbacks = []
-    receipts = []
-    queue = Queue(maxsize = 5)
     announce_time = 600
 
-    def __init__(self, name='LXMFAPI', announce=600, announce_immediately=False):
+    def __init__(self, name='LXMFAPI', announce=600, announce_immediately=False, max_pending=256):
+        # Imported on first construction and bound at module level for the
+        # other methods, so importing this module stays cheap
+        global RNS, LXMRouter, LXMessage
+        import RNS
+        from LXMF import LXMRouter, LXMessage
+        self.delivery_callbacks = []
+        self.pending = 0
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+        self.max_pending = max_pending
+        self.receipts = deque(maxlen=100)
+        self._receipt_set = set()
+        self._destinations = OrderedDict()
+        self._destinations_lock = threading.Lock()
         self.config_path = os.path.join(os.getcwd(), 'config')
         if not os.path.isdir(self.config_path):
             os.mkdir(self.config_path)
@@ -30,46 +66,53 @@ class LXMFAPI:
             id.to_file(idfile)
         self.id = RNS.Identity.from_file(idfile)
         RNS.log('Loaded identity from file', RNS.LOG_INFO)
+        self.announce_time = announce
+        self._announce_path = os.path.join(self.config_path, "announce")
         if announce_immediately:
-            af = os.path.join(self.config_path, "announce")
-            if os.path.isfile(af):
-                os.remove(af)
-                RNS.log('Announcing now. Timer reset.', RNS.LOG_INFO)
+            self._next_announce = 0
+            RNS.log('Announcing now. Timer reset.', RNS.LOG_INFO)
+        else:
+            self._next_announce = self._load_next_announce()
         RNS.Reticulum(loglevel=RNS.LOG_VERBOSE)
         self.router = LXMRouter(identity = self.id, storagepath = self.config_path)
         self.local = self.router.register_delivery_identity(self.id, display_name=name)
         self.router.register_delivery_callback(self._message_received)
-        RNS.log('LXMF Router ready to receive on: {}'.format(RNS.prettyhexrep(self.local.hash)), RNS.LOG_INFO)
-        self._announce()
-        self._start_queue_processor()
+        self.address = RNS.prettyhexrep(self.local.hash)
+        RNS.log('LXMF Router ready to receive on: {}'.format(self.address), RNS.LOG_INFO)
+        self._start_announcer()
 
-    def _start_queue_processor(self):
-        def process_queue():
+    def _start_announcer(self):
+        # Announcing signs and writes the deadline file, so keep it on this
+        # thread and off whatever thread (possibly an event loop) built us
+        def announce_loop():
             while True:
-                if not self.queue.empty():
-                    lxm = self.queue.get()
-                    self.router.handle_outbound(lxm)
+                time.sleep(max(0, self._next_announce - time.monotonic()))
                 self._announce()
-                time.sleep(10)
-        
-        thread = threading.Thread(target=process_queue, daemon=True)
+
+        thread = threading.Thread(target=announce_loop, daemon=True)
         thread.start()
 
-    def _announce(self):
-        announce_path = os.path.join(self.config_path, "announce")
-        if os.path.isfile(announce_path):
-            with open(announce_path, "r") as f:
+    def _load_next_announce(self):
+        # The file stores a wall-clock deadline so it survives restarts
+        try:
+            with open(self._announce_path, "r") as f:
                 announce = int(f.readline())
-        else:
-            announce = 1
-        if announce > int(time.time()):
+        except (OSError, ValueError):
+            return 0
+        return time.monotonic() + max(0, announce - time.time())
+
+    def _save_next_announce(self):
+        with open(self._announce_path, "w") as af:
+            af.write(str(int(time.time() + max(0, self._next_announce - time.monotonic()))))
+
+    def _announce(self):
+        if time.monotonic() < self._next_announce:
             RNS.log('Recent announcement', RNS.LOG_DEBUG)
-        else:
-            with open(announce_path, "w+") as af:
-                next_announce = int(time.time()) + self.announce_time
-                af.write(str(next_announce))
-            self.local.announce()
-            RNS.log('Announcement sent, expr set 1800 seconds', RNS.LOG_INFO)
+            return
+        self.local.announce()
+        self._next_announce = time.monotonic() + self.announce_time
+        self._save_next_announce()
+        RNS.log(f'Announcement sent, next in {self.announce_time} seconds', RNS.LOG_INFO)
 
     def received(self, function):
         self.delivery_callbacks.append(function)
@@ -80,102 +123,238 @@ class LXMFAPI:
         receipt = RNS.hexrep(message.hash, delimit=False)
         RNS.log(f'Message receipt <{receipt}>', RNS.LOG_INFO)
         def reply(msg):
-            self.send(sender, msg)
-        if receipt not in self.receipts:
+            # handle_outbound signs and can wait on the router, so it must not
+            # run on this RNS delivery thread; go through send() like /send does
+            if self.loop is None:
+                lxm = self._prepare(sender, msg)
+                if lxm is not None:
+                    threading.Thread(target=self.router.handle_outbound, args=(lxm,), daemon=True).start()
+                return
+            future = asyncio.run_coroutine_threadsafe(self.send(sender, msg), self.loop)
+            future.add_done_callback(self._reply_done)
+        if receipt not in self._receipt_set:
+            if len(self.receipts) == self.receipts.maxlen:
+                self._receipt_set.discard(self.receipts[0])
             self.receipts.append(receipt)
-            if len(self.receipts) > 100:
-                self.receipts.pop(0)
+            self._receipt_set.add(receipt)
+            msg = InboundMessage(message, reply, sender, message.content.decode('utf-8'), receipt)
             for callback in self.delivery_callbacks:
-                obj = {
-                    'lxmf' : message,
-                    'reply' : reply,
-                    'sender' : sender,
-                    'content' : message.content.decode('utf-8'),
-                    'hash' : receipt
-                }
-                msg = SimpleNamespace(**obj)
                 callback(msg)
 
-    def send(self, destination, message, title='Reply'):
+    def _reply_done(self, future):
+        if future.exception() is not None:
+            RNS.log(f'Reply failed: {future.exception()}', RNS.LOG_ERROR)
+
+    def _destination(self, hash, maxsize=128):
+        with self._destinations_lock:
+            destination = self._destinations.get(hash)
+            if destination is not None:
+                self._destinations.move_to_end(hash)
+                return destination
+        id = RNS.Identity.recall(hash)
+        # Misses are not cached so an announce arriving later is picked up
+        if id is None:
+            return None
+        destination = RNS.Destination(id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+        with self._destinations_lock:
+            destination = self._destinations.setdefault(hash, destination)
+            if len(self._destinations) > maxsize:
+                self._destinations.popitem(last=False)
+        return destination
+
+    async def send(self, destination, message, title='Reply'):
+        if self.pending >= self.max_pending:
+            raise Full('Outbound queue full')
+        lxm = self._prepare(destination, message, title)
+        if lxm is None:
+            return
+        self.pending += 1
+        try:
+            await asyncio.to_thread(self.router.handle_outbound, lxm)
+        finally:
+            self.pending -= 1
+
+    def _prepare(self, destination, message, title='Reply'):
+        if len(destination) != _EXPECTED_HEX_LEN:
+            raise ValueError("Invalid destination hash length")
         try:
             hash = bytes.fromhex(destination)
+        except ValueError:
+            raise ValueError("Invalid destination hash") from None
+        lxmf_destination = self._destination(hash)
+        if lxmf_destination == None:
+            RNS.log("Could not recall an Identity for the requested address. You have probably never received an announce from it. Try requesting a path from the network first. In fact, let's do this now :)", RNS.LOG_ERROR)
+            RNS.Transport.request_path(hash)
+            RNS.log("OK, a path was requested. If the network knows a path, you will receive an announce with the Identity data shortly.", RNS.LOG_INFO)
+            return None
+        lxm = LXMessage(lxmf_destination, self.local, message, title=title, desired_method=LXMessage.DIRECT)
+        lxm.try_propagation_on_fail = True
+        return lxm
+
+class ConnectionManager:
+    def __init__(self):
+        self.active = {}
+        self.loop = None
+
+    def connect(self, websocket):
+        self.loop = asyncio.get_running_loop()
+        state = SimpleNamespace(last_pong=time.monotonic(), rtt=None)
+        self.active[websocket] = state
+        return state
+
+    def disconnect(self, websocket):
+        self.active.pop(websocket, None)
+
+    def pong(self, state, ts):
+        state.last_pong = time.monotonic()
+        if isinstance(ts, (int, float)):
+            state.rtt = state.last_pong - ts
+
+    async def heartbeat(self, websocket, state, interval=HEARTBEAT_INTERVAL):
+        # Evicts peers that vanished without a close, e.g. behind NAT or a proxy
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if time.monotonic() - state.last_pong > 2 * interval:
+                    print("WebSocket client missed two heartbeats, closing")
+                    self.disconnect(websocket)
+                    await websocket.close(code=1001)
+                    return
+                await websocket.send_text(orjson.dumps({"type": "ping", "ts": time.monotonic()}).decode('utf-8'))
         except Exception as e:
-            RNS.log("Invalid destination hash", RNS.LOG_ERROR)
+            print(f"WebSocket heartbeat stopped: {e}")
+
+    async def broadcast(self, payload):
+        await asyncio.gather(*(ws.send_text(payload) for ws in list(self.active)), return_exceptions=True)
+
+    def deliver(self, msg):
+        if self.loop is None or not self.active:
             return
-        if not len(hash) == RNS.Reticulum.TRUNCATED_HASHLENGTH//8:
-            RNS.log("Invalid destination hash length", RNS.LOG_ERROR)
-        else:
-            id = RNS.Identity.recall(hash)
-            if id == None:
-                RNS.log("Could not recall an Identity for the requested address. You have probably never received an announce from it. Try requesting a path from the network first. In fact, let's do this now :)", RNS.LOG_ERROR)
-                RNS.Transport.request_path(hash)
-                RNS.log("OK, a path was requested. If the network knows a path, you will receive an announce with the Identity data shortly.", RNS.LOG_INFO)
-            else:
-                lxmf_destination = RNS.Destination(id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
-                lxm = LXMessage(lxmf_destination, self.local, message, title=title, desired_method=LXMessage.DIRECT)
-                lxm.try_propagation_on_fail = True
-                self.queue.put(lxm)
-
-app = FastAPI()
-api = LXMFAPI()
+        print(f"Received LXMF message, broadcasting to websockets: {msg.content}")
+        # Text frames keep browser clients working; decoding once is cheap
+        payload = orjson.dumps({
+            "sender": msg.sender,
+            "content": msg.content,
+            "hash": msg.hash
+        }).decode('utf-8')
+        asyncio.run_coroutine_threadsafe(self.broadcast(payload), self.loop)
+
+_router_lock = None
+
+def _claim_router():
+    # One router per identity: extra uvicorn workers would each register the
+    # same delivery destination, so only the worker holding this lock runs it
+    global _router_lock
+    if fcntl is None or _router_lock is not None:
+        return True
+    config_path = os.path.join(os.getcwd(), 'config')
+    os.makedirs(config_path, exist_ok=True)
+    lockfile = open(os.path.join(config_path, "lock"), "w")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockfile.close()
+        return False
+    _router_lock = lockfile
+    return True
+
+def _require_router():
+    if api is None:
+        raise HTTPException(status_code=503, detail="This worker does not run the LXMF router; another worker owns it")
+
+@contextmanager
+def _server_signal_handlers():
+    # Reticulum() installs its own SIGINT/SIGTERM handlers. On the main thread
+    # put the server's back afterwards so shutdown still goes through the
+    # lifespan; elsewhere (e.g. TestClient) signal.signal would raise, and
+    # there are no handlers of ours to protect, so let it be a no-op
+    if threading.current_thread() is threading.main_thread():
+        handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            yield
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+    else:
+        install = signal.signal
+        signal.signal = lambda sig, handler: signal.getsignal(sig)
+        try:
+            yield
+        finally:
+            signal.signal = install
+
+@asynccontextmanager
+async def lifespan(app):
+    global api
+    # Sized pool for the handle_outbound calls made through asyncio.to_thread
+    executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='lxmf-send')
+    asyncio.get_running_loop().set_default_executor(executor)
+    if not _claim_router():
+        print("LXMF router is owned by another worker, this worker answers 503")
+        yield
+        return
+    # Built here rather than at import so RNS and LXMF load only when serving
+    with _server_signal_handlers():
+        api = LXMFAPI()
+    api.received(manager.deliver)
+    yield
+
+app = FastAPI(lifespan=lifespan)
+api = None
+manager = ConnectionManager()
 
 @app.post("/send")
 async def send_message(message_request: MessageRequest):
+    _require_router()
     try:
-        api.send(
+        await api.send(
             message_request.destination,
             message_request.message,
             message_request.title
         )
         return {"status": "message queued"}
+    except Full as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/status")
 async def get_status():
+    _require_router()
     return {
-        "queue_size": api.queue.qsize(),
+        "queue_size": api.pending,
         "receipts": len(api.receipts),
-        "address": RNS.prettyhexrep(api.local.hash)
+        "address": api.address,
+        "websockets": len(manager.active),
+        "max_rtt": max((state.rtt for state in manager.active.values() if state.rtt is not None), default=None)
     }
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    _require_router()
     await websocket.accept()
     print("WebSocket client connected")
-    
-    message_queue = asyncio.Queue()
-    loop = asyncio.get_event_loop()
-    
-    def message_callback(msg):
-        print(f"Received LXMF message, queueing for websocket: {msg.content}")
-        loop.call_soon_threadsafe(
-            lambda: asyncio.run_coroutine_threadsafe(
-                message_queue.put({
-                    "sender": msg.sender,
-                    "content": msg.content,
-                    "hash": msg.hash
-                }), 
-                loop
-            )
-        )
-    
-    api.received(message_callback)
+    state = manager.connect(websocket)
+    heartbeat = asyncio.create_task(manager.heartbeat(websocket, state))
     
     try:
         while True:
+            data = await websocket.receive_text()
             try:
-                message = await asyncio.wait_for(message_queue.get(), timeout=1.0)
-                print(f"Sending message to websocket: {message}")
-                await websocket.send_json(message)
-            except asyncio.TimeoutError:
-                # No message in queue, continue waiting
+                message = orjson.loads(data)
+            except orjson.JSONDecodeError:
                 continue
-            except Exception as e:
-                print(f"Error in websocket loop: {e}")
-                break
+            if isinstance(message, dict) and message.get("type") == "pong":
+                manager.pong(state, message.get("ts"))
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         print(f"WebSocket connection closed: {e}")
     finally:
-        api.delivery_callbacks.remove(message_callback)
-        print("WebSocket client disconnected")
\ No newline at end of file
+        heartbeat.cancel()
+        manager.disconnect(websocket)
+        print("WebSocket client disconnected")
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app)
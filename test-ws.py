@@ -16,6 +16,9 @@ async def listen_for_messages():
                     try:
                         message = await websocket.recv()
                         data = json.loads(message)
+                        if data.get('type') == 'ping':
+                            await websocket.send(json.dumps({'type': 'pong', 'ts': data['ts']}))
+                            continue
                         print("\nNew message received:")
                         print(f"From: {data['sender']}")
                         print(f"Content: {data['content']}")